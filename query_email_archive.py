@@ -8,22 +8,254 @@ import sqlite3
 import argparse
 import sys
 from datetime import datetime
-from typing import Optional, List, Tuple
+from itertools import chain
+from typing import Optional, List, Tuple, Iterable, Iterator
 import json
 
+try:
+    import orjson  # Optional: much faster JSON encoding for --export
+except ImportError:
+    orjson = None
+
 DB_FILE = "email_archive.db"
 
 
+def _contains(value: str) -> List[str]:
+    """Parameters for a partial-match LIKE predicate."""
+    return [f"%{value}%"]
+
+
+def _exact(value: str) -> List[str]:
+    """Parameters for an exact-match predicate."""
+    return [value]
+
+
+def _like_escape(value: str) -> str:
+    """Escape LIKE wildcards so the value matches literally (ESCAPE '\\')."""
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _domain_list_patterns(value: str) -> List[str]:
+    """Patterns matching a domain or its subdomains in ',' || domains_found || ','."""
+    domain = _like_escape(value)
+    return [f"%,{domain},%", f"%.{domain},%"]
+
+
+def _domain_index_params(value: str) -> List[str]:
+    """Parameters matching a domain or its subdomains via email_domains.reversed_domain."""
+    reversed_domain = value[::-1]
+    return [reversed_domain, reversed_domain, reversed_domain]
+
+
+# Filter name -> (SQL predicate, parameter builder) for query_emails.
+# Domains are case-folded by SQLite only (lower() and LIKE, both ASCII-only),
+# so stored and queried values are always normalised the same way.
+_FILTERS = {
+    "sender": ("sender LIKE ?", _contains),
+    "recipient": ("recipient LIKE ?", _contains),
+    "subject": ("subject LIKE ?", _contains),
+    "date_from": ("date >= ?", _exact),
+    "date_to": ("date <= ?", _exact),
+    "domain": ("(',' || domains_found || ',' LIKE ? ESCAPE '\\'"
+               " OR ',' || domains_found || ',' LIKE ? ESCAPE '\\')", _domain_list_patterns),
+    # Subdomains of x are the reversed names in [reverse(x) || '.', reverse(x) || '/')
+    "domain_indexed": ("id IN (SELECT email_id FROM email_domains"
+                       " WHERE reversed_domain = lower(?)"
+                       " OR (reversed_domain >= lower(?) || '.' AND reversed_domain < lower(?) || '/'))",
+                       _domain_index_params),
+    "search_body": ("body LIKE ?", _contains),
+    "search_body_fts": ("id IN (SELECT rowid FROM emails_fts WHERE body LIKE ?)", _contains),
+}
+
+# Adds one email_domains row per comma-separated entry of domains_found for the
+# (id, domains_found) rows selected by {source}. Shared by the backfill and the
+# sync triggers so both split and normalise entries the same way. Each entry is
+# also stored reversed, which turns subdomain matching into an index range scan.
+_INSERT_EMAIL_DOMAINS = """
+    INSERT INTO email_domains (email_id, domain, reversed_domain)
+    WITH RECURSIVE
+        source(email_id, domains_found) AS ({source}),
+        split(email_id, rest, entry) AS (
+            SELECT email_id, domains_found || ',', NULL
+            FROM source WHERE domains_found IS NOT NULL
+            UNION ALL
+            SELECT email_id,
+                   substr(rest, instr(rest, ',') + 1),
+                   lower(trim(substr(rest, 1, instr(rest, ',') - 1)))
+            FROM split WHERE rest != ''
+        ),
+        reversal(email_id, domain, pos, reversed_domain) AS (
+            SELECT email_id, entry, length(entry), ''
+            FROM split WHERE entry != ''
+            UNION ALL
+            SELECT email_id, domain, pos - 1, reversed_domain || substr(domain, pos, 1)
+            FROM reversal WHERE pos > 0
+        )
+    SELECT email_id, domain, reversed_domain FROM reversal WHERE pos = 0
+"""
+
 def connect_db(db_file: str = DB_FILE) -> sqlite3.Connection:
     """Connect to the email archive database."""
     try:
         conn = sqlite3.connect(db_file)
+        conn.isolation_level = None  # Manage transactions explicitly
         conn.row_factory = sqlite3.Row  # Enable column access by name
-        return conn
+        # The archive is rebuildable, so NORMAL sync is enough.
+        # Larger cache + mmap speed up the LIKE scans.
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+        conn.execute("PRAGMA mmap_size=268435456")
     except sqlite3.Error as e:
         print(f"Error connecting to database: {e}")
         sys.exit(1)
 
+    # WAL lets queries run alongside the archiver. The mode is stored in the
+    # database file, so this needs write access; a read-only archive is
+    # queried in whatever mode the archiver left it.
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+    except sqlite3.OperationalError:
+        pass
+    return conn
+
+
+def _fts_trigram_available(conn: sqlite3.Connection) -> bool:
+    """Check whether this SQLite build supports FTS5 with the trigram tokenizer."""
+    try:
+        # The temp schema is private to this connection, so probing writes nothing
+        conn.execute("CREATE VIRTUAL TABLE temp.fts_probe USING fts5(x, tokenize='trigram')")
+        conn.execute("DROP TABLE temp.fts_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
+
+
+def build_indexes(conn: sqlite3.Connection):
+    """Create the optional search indexes, full-text table and sync triggers.
+
+    Only run when asked for (--build-index): it changes the archiver's schema
+    and installs triggers that run on every archiver INSERT.
+    """
+    cursor = conn.cursor()
+    use_fts = _fts_trigram_available(conn)
+    schema_objects = [
+        'idx_emails_date', 'idx_emails_sender',
+        'email_domains', 'idx_email_domains_reversed', 'idx_email_domains_email',
+        'email_domains_ai', 'email_domains_ad', 'email_domains_au',
+    ]
+    if use_fts:
+        schema_objects += ['emails_fts', 'emails_fts_ai', 'emails_fts_ad', 'emails_fts_au']
+    cursor.execute(
+        f"SELECT COUNT(*) FROM sqlite_master WHERE name IN ({','.join('?' * len(schema_objects))})",
+        schema_objects
+    )
+    if cursor.fetchone()[0] == len(schema_objects):
+        return  # Nothing to create; don't take the write lock
+
+    print("Building search indexes (this can take a while on a large archive)...")
+    try:
+        # Take the write lock up front so a concurrent archiver can't deadlock us
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_date ON emails(date DESC)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_emails_sender ON emails(sender)")
+
+        # One row per (email, domain) so --domain is an index lookup, not a LIKE scan
+        if not has_table(conn, 'email_domains'):
+            cursor.execute("""
+                CREATE TABLE email_domains (
+                    email_id INTEGER NOT NULL REFERENCES emails(id),
+                    domain TEXT NOT NULL,
+                    reversed_domain TEXT NOT NULL
+                )
+            """)
+            sync_domain_index(conn)
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS idx_email_domains_reversed"
+            " ON email_domains(reversed_domain, email_id)"
+        )
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_email_domains_email ON email_domains(email_id)")
+
+        # Keep email_domains in sync with rows the archiver inserts, updates or deletes
+        insert_new_domains = _INSERT_EMAIL_DOMAINS.format(source="SELECT new.id, new.domains_found")
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS email_domains_ai AFTER INSERT ON emails BEGIN
+                {insert_new_domains};
+            END
+        """)
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS email_domains_ad AFTER DELETE ON emails BEGIN
+                DELETE FROM email_domains WHERE email_id = old.id;
+            END
+        """)
+        cursor.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS email_domains_au AFTER UPDATE OF id, domains_found ON emails BEGIN
+                DELETE FROM email_domains WHERE email_id = old.id;
+                {insert_new_domains};
+            END
+        """)
+
+        # Without trigram support body search stays a plain LIKE on emails
+        if use_fts:
+            if not has_table(conn, 'emails_fts'):
+                cursor.execute("""
+                    CREATE VIRTUAL TABLE emails_fts
+                    USING fts5(subject, body, content='emails', content_rowid='id',
+                               tokenize='trigram')
+                """)
+                cursor.execute("INSERT INTO emails_fts(emails_fts) VALUES ('rebuild')")
+
+            # Keep the full-text index in sync with rows written by the archiver
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS emails_fts_ai AFTER INSERT ON emails BEGIN
+                    INSERT INTO emails_fts(rowid, subject, body)
+                    VALUES (new.id, new.subject, new.body);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS emails_fts_ad AFTER DELETE ON emails BEGIN
+                    INSERT INTO emails_fts(emails_fts, rowid, subject, body)
+                    VALUES ('delete', old.id, old.subject, old.body);
+                END
+            """)
+            cursor.execute("""
+                CREATE TRIGGER IF NOT EXISTS emails_fts_au AFTER UPDATE ON emails BEGIN
+                    INSERT INTO emails_fts(emails_fts, rowid, subject, body)
+                    VALUES ('delete', old.id, old.subject, old.body);
+                    INSERT INTO emails_fts(rowid, subject, body)
+                    VALUES (new.id, new.subject, new.body);
+                END
+            """)
+        cursor.execute("COMMIT")
+    except sqlite3.Error as e:
+        if conn.in_transaction:
+            cursor.execute("ROLLBACK")
+        print(f"Error preparing database indexes: {e}")
+        sys.exit(1)
+
+    if use_fts:
+        print("Search indexes ready.")
+    else:
+        print("Search indexes ready (full-text search not supported by this SQLite build).")
+
+
+def sync_domain_index(conn: sqlite3.Connection):
+    """Rebuild email_domains from each email's domains_found column.
+
+    Runs inside build_indexes' transaction; the email_domains triggers keep
+    the table current after that.
+    """
+    cursor = conn.cursor()
+    cursor.execute("DELETE FROM email_domains")
+    cursor.execute(_INSERT_EMAIL_DOMAINS.format(source="SELECT id, domains_found FROM emails"))
+
+
+def has_table(conn: sqlite3.Connection, name: str) -> bool:
+    """Check whether a table exists in the database."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,))
+    return cursor.fetchone() is not None
+
 
 def get_stats(conn: sqlite3.Connection) -> dict:
     """Get statistics about the email archive."""
@@ -93,54 +325,76 @@ def query_emails(
     offset: int = 0,
     show_body: bool = False,
     max_body_length: int = 200
-) -> List[sqlite3.Row]:
-    """Query emails with various filters."""
+) -> Iterator[sqlite3.Row]:
+    """Query emails with various filters, yielding rows as they are read."""
     cursor = conn.cursor()
     
-    query = "SELECT * FROM emails WHERE 1=1"
-    params = []
-    
-    if sender:
-        query += " AND sender LIKE ?"
-        params.append(f"%{sender}%")
-    
-    if recipient:
-        query += " AND recipient LIKE ?"
-        params.append(f"%{recipient}%")
-    
-    if subject:
-        query += " AND subject LIKE ?"
-        params.append(f"%{subject}%")
-    
-    if date_from:
-        query += " AND date >= ?"
-        params.append(date_from)
-    
-    if date_to:
-        query += " AND date <= ?"
-        params.append(date_to)
-    
-    if domain:
-        query += " AND domains_found LIKE ?"
-        params.append(f"%{domain}%")
-    
-    if search_body:
-        query += " AND body LIKE ?"
-        params.append(f"%{search_body}%")
+    use_fts = bool(search_body) and has_table(conn, 'emails_fts')
+    use_domain_index = bool(domain) and has_table(conn, 'email_domains')
+    values = {
+        "sender": sender,
+        "recipient": recipient,
+        "subject": subject,
+        "date_from": date_from,
+        "date_to": date_to,
+        "domain_indexed" if use_domain_index else "domain": domain,
+        "search_body_fts" if use_fts else "search_body": search_body,
+    }
+    active = tuple(name for name in _FILTERS if values.get(name))
     
+    # Same filters give the same SQL text, so sqlite3's statement cache
+    # reuses the prepared statement across calls on a connection
+    query = "SELECT * FROM emails WHERE 1=1"
+    for name in active:
+        query += f" AND {_FILTERS[name][0]}"
     query += " ORDER BY date DESC LIMIT ? OFFSET ?"
+    
+    params = [param for name in active for param in _FILTERS[name][1](values[name])]
     params.extend([limit, offset])
     
     cursor.execute(query, params)
-    return cursor.fetchall()
+    yield from cursor
 
 
-def export_to_json(rows: List[sqlite3.Row], output_file: str):
-    """Export query results to JSON file."""
-    data = [dict(row) for row in rows]
-    with open(output_file, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
-    print(f"\nExported {len(data)} emails to {output_file}")
+def _dump_json(obj) -> bytes:
+    """Encode an object as indented UTF-8 JSON, using orjson when available."""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def export_to_json(rows: Iterable[sqlite3.Row], output_file: str) -> int:
+    """Export query results to JSON file, writing one row at a time.
+
+    Returns the number of emails written.
+    """
+    count = 0
+    columns = None
+    with open(output_file, 'wb') as f:
+        f.write(b"[")
+        for row in rows:
+            if columns is None:
+                columns = row.keys()
+            f.write(b",\n  " if count else b"\n  ")
+            # Nest each record one level, matching json.dump(rows, indent=2)
+            f.write(_dump_json(dict(zip(columns, row))).replace(b"\n", b"\n  "))
+            count += 1
+        f.write(b"\n]" if count else b"]")
+    return count
+
+
+def display_rows(
+    rows: Iterable[sqlite3.Row],
+    show_body: bool = False,
+    max_body_length: int = 200
+) -> Iterator[sqlite3.Row]:
+    """Print each row as it streams past and pass it on to the caller."""
+    for i, row in enumerate(rows, 1):
+        print(f"\n[{i}]")
+        print("-"*80)
+        print(format_email(row, show_body=show_body, max_body_length=max_body_length))
+        print()
+        yield row
 
 
 def main():
@@ -172,6 +426,11 @@ Examples:
 
   # Export results to JSON
   python query_email_archive.py --sender "example.com" --export results.json
+
+  # Build the optional search indexes (changes the database schema).
+  # Run this after the archiver's initial backfill, not before: the sync
+  # triggers it installs make every archiver INSERT pay for the indexing.
+  python query_email_archive.py --build-index
         """
     )
     
@@ -182,18 +441,25 @@ Examples:
     parser.add_argument("--subject", help="Filter by subject (partial match)")
     parser.add_argument("--date-from", help="Filter emails from this date (YYYY-MM-DD)")
     parser.add_argument("--date-to", help="Filter emails to this date (YYYY-MM-DD)")
-    parser.add_argument("--domain", help="Filter by domain found in email body")
+    parser.add_argument("--domain", help="Filter by domain found in email body (case-insensitive, includes subdomains)")
     parser.add_argument("--search-body", help="Search for text in email body")
     parser.add_argument("--limit", type=int, default=50, help="Maximum number of results (default: 50)")
     parser.add_argument("--offset", type=int, default=0, help="Offset for pagination (default: 0)")
     parser.add_argument("--show-body", action="store_true", help="Show email body in results")
     parser.add_argument("--max-body-length", type=int, default=200, help="Max body length when showing body (default: 200)")
     parser.add_argument("--export", help="Export results to JSON file")
+    parser.add_argument("--build-index", action="store_true",
+                        help="Create search indexes, full-text table and sync triggers in the database "
+                             "(run after the initial archive backfill; the triggers slow down archiver inserts)")
     
     args = parser.parse_args()
     
     conn = connect_db(args.db)
     
+    # Schema changes only happen when explicitly requested
+    if args.build_index:
+        build_indexes(conn)
+
     # Show statistics
     if args.stats:
         stats = get_stats(conn)
@@ -218,9 +484,10 @@ Examples:
     ])
     
     if not has_filters:
-        print("No filters specified. Use --stats to see database statistics,")
-        print("or provide at least one filter (--sender, --subject, etc.)")
-        print("Use --help for examples.")
+        if not args.build_index:
+            print("No filters specified. Use --stats to see database statistics,")
+            print("or provide at least one filter (--sender, --subject, etc.)")
+            print("Use --help for examples.")
         conn.close()
         return
     
@@ -240,27 +507,30 @@ Examples:
         max_body_length=args.max_body_length
     )
     
-    if not rows:
+    # Check for results before creating the export file
+    first = next(rows, None)
+    if first is None:
         print("No emails found matching the criteria.")
         conn.close()
         return
     
-    # Display results
-    print(f"\nFound {len(rows)} email(s):\n")
-    print("="*80)
-    
-    for i, row in enumerate(rows, 1):
-        print(f"\n[{i}/{len(rows)}]")
-        print("-"*80)
-        print(format_email(row, show_body=args.show_body, max_body_length=args.max_body_length))
-        print()
+    # Display results as they stream in, writing each to the export file as we go
+    print("\n" + "="*80)
+    displayed = display_rows(
+        chain([first], rows),
+        show_body=args.show_body,
+        max_body_length=args.max_body_length
+    )
+    if args.export:
+        count = export_to_json(displayed, args.export)
+    else:
+        count = sum(1 for _ in displayed)
     
     print("="*80)
-    print(f"\nTotal: {len(rows)} email(s)")
+    print(f"\nTotal: {count} email(s)")
     
-    # Export if requested
     if args.export:
-        export_to_json(rows, args.export)
+        print(f"\nExported {count} emails to {args.export}")
     
     conn.close()
 